@@ -4,13 +4,85 @@ __date of creation__: 2023-04-04
 __last modified__: 2023-05-26
 """
 
+import re
 import sys
 import json
-from collections import deque
+import sqlite3
+import threading
+from collections import OrderedDict
+from itertools import cycle
+from concurrent.futures import ThreadPoolExecutor
 import requests as httpclient
 
 
-class TravelTimeOSRMCH:
+class _CacheFile:
+    """
+    Holds the connection to the file given as cache_path. Instances that share a cache (see TravelTimeOSRMCHPool)
+    hold the same _CacheFile, so closing it is seen by all of them
+    """
+
+    def __init__(self, connection=None):
+        self.connection = connection
+
+
+class _TravelTimeQueueMixin:
+    """
+    Queue and concurrency methods shared by TravelTimeOSRMCH and TravelTimeOSRMCHPool.
+    Classes that use it provide _pending (array of queued scenarios), _resolve_longlats() and flush()
+    """
+
+    def enqueue_travel_time_many_to_one(self, sources_longlats, destination_longlat):
+        """
+        Queues a MANY-TO-ONE scenario instead of sending it to the server directly. All queued scenarios are sent
+        in a single request when flush() is called
+        :param sources_longlats: Same as get_travel_time_many_to_one
+        :param destination_longlat: Same as get_travel_time_many_to_one
+        :return: Index of the scenario in the array returned by flush()
+        """
+
+        self._pending.append(("many_to_one", self._resolve_longlats(sources_longlats), [destination_longlat]))
+        return len(self._pending) - 1
+
+    def enqueue_travel_time_one_to_many(self, source_longlat, destinations_longlats):
+        """
+        Queues a ONE-TO-MANY scenario instead of sending it to the server directly. All queued scenarios are sent
+        in a single request when flush() is called
+        :param source_longlat: Same as get_travel_time_one_to_many
+        :param destinations_longlats: Same as get_travel_time_one_to_many
+        :return: Index of the scenario in the array returned by flush()
+        """
+
+        self._pending.append(("one_to_many", [source_longlat], self._resolve_longlats(destinations_longlats)))
+        return len(self._pending) - 1
+
+    def enqueue_travel_time_one_to_one(self, source_longlat, destination_longlat):
+        """
+        Queues a ONE-TO-ONE scenario instead of sending it to the server directly. All queued scenarios are sent
+        in a single request when flush() is called
+        :param source_longlat: Array of (ONE) longitude + latitude combination in format --> [longitude, latitude]
+        :param destination_longlat: Array of (ONE) longitude + latitude combination in format --> [longitude, latitude]
+        :return: Index of the scenario in the array returned by flush()
+        """
+
+        self._pending.append(("one_to_one", [source_longlat], [destination_longlat]))
+        return len(self._pending) - 1
+
+    def get_travel_times_concurrent(self, method, list_of_args, max_workers=None):
+        """
+        Used when several independent scenarios can not be combined into one request, e.g. many MANY-TO-ONE scenarios.
+        Requests are sent concurrently instead of one after another
+        :param method: Method of this instance to call for every scenario (e.g. self.get_travel_time_many_to_one)
+        :param list_of_args: Array of arguments for every call to method in format --> [(arg1, arg2), (arg1, arg2), ...]
+        :param max_workers: Maximum number of simultaneous requests, preferably the number of threads used by the
+            OSRM server (defaults to ThreadPoolExecutor default)
+        :return: Array of return values from method, aligned with list_of_args
+        """
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda args: method(*args), list_of_args))
+
+
+class TravelTimeOSRMCH(_TravelTimeQueueMixin):
     '''
     Class used to query OpenSourceRoutingMachine Docker Container (server) for travel time calculations.
     Provides three methods depending on use case:
@@ -21,72 +93,329 @@ class TravelTimeOSRMCH:
 
     :var (str) ip_address: Input ip address of OSRM server (e.g. 127.0.0.1 if it is running on the same computer)
     :var (str) port: Input port of OSRM server (e.g. 5001, same port as your instance of OSRM server)
+    :var (str) cache_path: Optional path to SQLite file where travel times are kept between simulation runs
+        (e.g. osrm_cache.db), new travel times are saved as soon as they are fetched. Call close() at the end of the
+        run, or use the instance as context manager (with TravelTimeOSRMCH(cache_path=...) as travel_time: ...)
+    :var (int) cache_maxsize: Maximum number of source + destination travel times kept in memory, the least recently
+        used are removed first (None keeps all of them)
+    :var (int) max_table_size: Maximum number of locations in one request, batches are split into several requests
+        above it (e.g. 100, same as --max-table-size of your instance of OSRM server)
     '''
 
-    ip_address = "127.0.0.1"
-    port = "5001"
-
-    # String that combines ip address and port to form correct url to call OSRM server
-    url = "http://" + ip_address + ":" + port + "/table/v1/driving/"
     # Required header to make call to OSRM server
     headers = {'Content-Type': 'application/json'}
 
-    def get_travel_time_many_to_one(self, sources_longlats, destination_longlat):
+    # Number of SECONDS per unit that travel times can be returned in
+    units_in_seconds = {"seconds": 1, "hours": 3600}
+
+    # Query strings of each scenario, built once instead of on every call
+    many_to_one_query = "?destinations=0&annotations=duration&skip_waypoints=true"
+    one_to_many_query = "?sources=0&annotations=duration&skip_waypoints=true"
+    one_to_one_query = "?sources=0&destinations=1&annotations=duration&skip_waypoints=true"
+    batch_query = "&annotations=duration&skip_waypoints=true"
+
+    # Used to find and parse only the durations matrix of a response
+    _durations_pattern = re.compile(r'"durations"\s*:\s*')
+    _json_decoder = json.JSONDecoder()
+
+    # Session shared by all calls, keeps connections to OSRM server alive and reuses them (connection pooling)
+    _session = httpclient.Session()
+    _session.mount("http://", httpclient.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=256, max_retries=0))
+
+    def __init__(self, ip_address="127.0.0.1", port="5001", cache_path=None, cache_maxsize=100000,
+                 max_table_size=100):
+        self.ip_address = ip_address
+        self.port = str(port)
+        self.max_table_size = max_table_size
+
+        # String that combines ip address and port to form correct url to call OSRM server
+        self.url = "http://" + self.ip_address + ":" + self.port + "/table/v1/driving/"
+
+        # Queue of scenarios (scenario, sources, destinations) waiting to be sent to the server in a single request
+        self._pending = []
+        # Travel times in SECONDS that have already been fetched from the server, keyed by source + destination.
+        # Ordered from least to most recently used, None means that the server found no route
+        self._travel_time_cache = OrderedDict()
+        self._cache_maxsize = cache_maxsize
+        # Cache is shared by threads of get_travel_times_concurrent
+        self._cache_lock = threading.Lock()
+        # Fixed sets of locations registered with register_locations, the index in the list is used as token
+        self._registered_locations = []
+
+        # Loads the most recently saved travel times of previous simulation runs (at most cache_maxsize of them).
+        # The connection is used by threads of get_travel_times_concurrent as well, access is guarded by the cache lock
+        self._cache_file = _CacheFile()
+        # Only the instance that opened the file closes it, instances that share it only drop their reference
+        self._owns_cache_file = True
+        if cache_path is not None:
+            self._cache_file.connection = sqlite3.connect(cache_path, check_same_thread=False)
+            self._cache_db.execute("PRAGMA journal_mode=WAL")
+            self._cache_db.execute("PRAGMA synchronous=NORMAL")
+            self._cache_db.execute("CREATE TABLE IF NOT EXISTS travel_times (src_lon REAL, src_lat REAL, "
+                                   "dst_lon REAL, dst_lat REAL, duration REAL, "
+                                   "UNIQUE (src_lon, src_lat, dst_lon, dst_lat))")
+            limit = -1 if cache_maxsize is None else cache_maxsize
+            rows = self._cache_db.execute("SELECT src_lon, src_lat, dst_lon, dst_lat, duration FROM travel_times "
+                                          "ORDER BY rowid DESC LIMIT ?", (limit,)).fetchall()
+
+            # INSERT OR REPLACE gives saved rows a new rowid, oldest rows are added first (least recently used)
+            for src_lon, src_lat, dst_lon, dst_lat, duration in reversed(rows):
+                self._travel_time_cache[(src_lon, src_lat), (dst_lon, dst_lat)] = duration
+
+    @property
+    def _cache_db(self):
+        """
+        Connection to the file given as cache_path (None without cache_path or after close())
+        """
+
+        return self._cache_file.connection
+
+    def close(self):
+        """
+        Closes the file given as cache_path (does nothing without cache_path). Travel times are already saved when
+        they are fetched, so nothing is lost if close() is never reached.
+        An instance that shares the file of another instance (see TravelTimeOSRMCHPool) stops saving to it instead
+        """
+
+        with self._cache_lock:
+            if self._owns_cache_file and self._cache_file.connection is not None:
+                self._cache_file.connection.close()
+                self._cache_file.connection = None
+            self._cache_file = _CacheFile()
+            self._owns_cache_file = True
+
+    def _share_cache(self, other):
+        """
+        Uses the cache (and cache_path) of another instance instead of own cache, see TravelTimeOSRMCHPool
+        """
+
+        self.close()
+        self._travel_time_cache = other._travel_time_cache
+        self._cache_maxsize = other._cache_maxsize
+        self._cache_lock = other._cache_lock
+        self._cache_file = other._cache_file
+        self._owns_cache_file = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def _cache_key(source_longlat, destination_longlat):
+        """
+        Builds hashable key for the travel time cache from a source + destination combination. Coordinates are
+        converted with float(), same as in requests and in the file given as cache_path
+        """
+
+        return ((float(source_longlat[0]), float(source_longlat[1])),
+                (float(destination_longlat[0]), float(destination_longlat[1])))
+
+    def _cache_lookup(self, keys):
+        """
+        Gets cached travel times and marks them as recently used
+        :return: Dictionary with travel times in SECONDS of the keys that are cached (None if no route was found)
+        """
+
+        cache = self._travel_time_cache
+        found = {}
+        with self._cache_lock:
+            for key in keys:
+                if key in cache:
+                    cache.move_to_end(key)
+                    found[key] = cache[key]
+        return found
+
+    def _cache_store(self, keys, durations):
+        """
+        Adds travel times in SECONDS to the cache, removes the least recently used ones above cache_maxsize.
+        Travel times are saved to the file given as cache_path right away, so they survive a crashed run
+        """
+
+        cache = self._travel_time_cache
+        with self._cache_lock:
+            for key, duration in zip(keys, durations):
+                cache[key] = duration
+                cache.move_to_end(key)
+            if self._cache_maxsize is not None:
+                while len(cache) > self._cache_maxsize:
+                    cache.popitem(last=False)
+
+            if self._cache_db is not None:
+                rows = [(src[0], src[1], dst[0], dst[1], duration) for (src, dst), duration in zip(keys, durations)]
+                self._cache_db.executemany("INSERT OR REPLACE INTO travel_times VALUES (?, ?, ?, ?, ?)", rows)
+                self._cache_db.commit()
+
+    def clear_cache(self):
+        """
+        Removes all cached travel times, e.g. when the map data of the OSRM server has been updated
+        """
+
+        with self._cache_lock:
+            self._travel_time_cache.clear()
+
+            if self._cache_db is not None:
+                self._cache_db.execute("DELETE FROM travel_times")
+                self._cache_db.commit()
+
+    def register_locations(self, longlats):
+        """
+        Registers a fixed set of locations (e.g. ambulance garages or hospitals) that is used in many scenarios.
+        Coordinates are only formatted for requests once, instead of on every call
+        :param longlats: Array of (MANY) longitude + latitude combinations in format
+            --> [[longitude, latitude], [longitude, latitude], ...] (NumPy array of shape (N, 2) is also accepted)
+        :return: Token that can be used instead of the array in get_travel_time_many_to_one (sources_longlats) and
+            get_travel_time_one_to_many (destinations_longlats)
+        """
+
+        longlats = self._as_longlats(longlats)
+        self._registered_locations.append((list(longlats), self._format_longlats(longlats)))
+        return len(self._registered_locations) - 1
+
+    def _resolve_longlats(self, longlats):
+        """
+        Converts token from register_locations or NumPy array to an array of longitude + latitude combinations
+        """
+
+        if isinstance(longlats, int):
+            return self._registered_locations[longlats][0]
+        return self._as_longlats(longlats)
+
+    @staticmethod
+    def _as_longlats(longlats):
+        """
+        Converts NumPy arrays of shape (N, 2) to an array of longitude + latitude combinations in one call, so the
+        coordinates are plain floats instead of NumPy scalars that are slow to access and format one by one
+        """
+
+        if hasattr(longlats, "tolist"):
+            return longlats.tolist()
+        return longlats
+
+    @staticmethod
+    def _format_longlats(longlats):
+        """
+        Formats longitude + latitude combinations for the request url in format --> longitude,latitude;longitude,latitude
+        Coordinates are rounded to 6 decimals (~11 cm), which is well within the precision OSRM snaps to roads with.
+        Coordinates given as strings (e.g. read from a CSV file) are converted with float() first
+        """
+
+        return ";".join(f"{float(obj[0]):.6f},{float(obj[1]):.6f}" for obj in longlats)
+
+    @classmethod
+    def _unit_in_seconds(cls, units):
+        """
+        Checks units argument before anything is sent to the server
+        :return: Number of SECONDS per unit
+        """
+
+        if units not in cls.units_in_seconds:
+            raise ValueError(f"units must be one of {', '.join(map(repr, cls.units_in_seconds))}, not {units!r}")
+        return cls.units_in_seconds[units]
+
+    @classmethod
+    def _parse_durations(cls, response):
+        """
+        Parses only the durations matrix of a response from the server, instead of the whole json object
+        :return: Durations matrix with travel times in SECONDS (rows are sources, columns are destinations)
+        """
+
+        text = response.content.decode()
+        match = cls._durations_pattern.search(text)
+
+        # Response without durations is an error from the server, e.g. {"code":"TooBig","message":"..."}
+        if match is None:
+            raise RuntimeError("OSRM server returned no travel times (HTTP " + str(response.status_code) + "): " + text)
+
+        return cls._json_decoder.raw_decode(text, match.end())[0]
+
+    @staticmethod
+    def _argmin_positive(durations, shortcut_threshold_seconds=0.0):
+        """
+        Finds the shortest travel time that is above zero
+        :param durations: Array of travel times in SECONDS (None if the server found no route)
+        :param shortcut_threshold_seconds: Returns the first travel time below this threshold instead of the shortest
+            (0 disables the shortcut)
+        :return:
+            1. saved_idx: Index of the shortest travel time (None if no travel time is valid)
+            2. travel_time: The shortest travel time in SECONDS (None if no travel time is valid)
+        """
+
+        # Stops at the first travel time below the threshold, since any of them is good enough for the caller
+        if shortcut_threshold_seconds > 0:
+            for idx, duration in enumerate(durations):
+                if duration is not None and 0 < duration < shortcut_threshold_seconds:
+                    return idx, duration
+
+        # Travel times of zero and None (no route) are not valid candidates, replaces them so the scan can be done
+        # by min() + index()
+        if 0 in durations or None in durations:
+            durations = [duration if duration is not None and duration > 0 else sys.maxsize for duration in durations]
+
+        travel_time = min(durations, default=sys.maxsize)
+
+        if travel_time == sys.maxsize:
+            return None, None
+
+        return durations.index(travel_time), travel_time
+
+    def get_travel_time_many_to_one(self, sources_longlats, destination_longlat, shortcut_threshold_seconds=0.0,
+                                    units="hours"):
         """
         Used for MANY-TO-ONE scenarios such as: "ambulances to patient"
         :param sources_longlats: Array of (MANY) longitude + latitude combinations. Represents starting
             locations (e.g. ambulance garages) in format --> [[longitude, latitude], [longitude, latitude], ...]
+            or token returned by register_locations (NumPy array of shape (N, 2) is also accepted)
         :param destination_longlat: Array of (ONE) longitude + latitude combination. Represents
             destination (e.g. a patient) in format --> [longitude, latitude]
+        :param shortcut_threshold_seconds: Travel time in SECONDS that is good enough (e.g. "any ambulance within
+            2 minutes"), the first source below it is returned instead of the closest one (0 disables the shortcut)
+        :param units: Unit of returned travel time, "hours" (default, fits simulation framework standards) or "seconds"
         :return:
-            1. travel_time: Travel time in HOURS
+            1. travel_time: Travel time in HOURS (or SECONDS, see units)
             2. source: Array object with longitude + latitude of source that has the shortest travel time to the destination
                 in format --> [longitude, latitude]
+                (travel_time and source are None if no source has a valid travel time to the destination)
             3. destination_longlat: Array object with longitude + latitude of destination
                 in format --> [longitude, latitude]
         """
 
-        # List of all locations (source + destinations), uses deque to be able to use appendleft-method
-        locations = deque(sources_longlats)
-        locations.appendleft(destination_longlat)
-
-        # Prepares string for request with matrix coordinates
-        data = ""
-        for obj in locations:
-            long_lat = str(obj[0]) + "," + str(obj[1]) + ";"
-            data += long_lat
-
-        # Removes trailing semicolon
-        data_obj = data.rstrip(';')
-
-        # Builds final string for GET request
-        ending_url = "?destinations=0&skip_waypoints=true"
-        request = self.url + data_obj + ending_url
+        unit_in_seconds = self._unit_in_seconds(units)
 
-        # Sends request to server
-        response = httpclient.get(request)
+        # Uses pre-formatted coordinates if a token from register_locations is given
+        sources_data = None
+        if isinstance(sources_longlats, int):
+            sources_longlats, sources_data = self._registered_locations[sources_longlats]
+        else:
+            sources_longlats = self._as_longlats(sources_longlats)
 
-        """
-        Only used for debugging HTTP request errors
-        """
-        # print(response.text)
-        # print(response.status_code, response.reason)
+        # A single source does not need a search for the shortest travel time, uses the ONE-TO-ONE request instead
+        if len(sources_longlats) == 1:
+            travel_time, source, _ = self.get_travel_time_one_to_one(sources_longlats[0], destination_longlat, units)
+            if not travel_time:
+                return None, None, destination_longlat
+            return travel_time, source, destination_longlat
 
-        # Converts response from json to object-structure
-        response_json = json.loads(response.text)
+        # Travel times in SECONDS from every source to the destination, taken from cache if all of them are known
+        keys = [self._cache_key(obj, destination_longlat) for obj in sources_longlats]
+        found = self._cache_lookup(keys)
 
-        travel_time = sys.maxsize
-        saved_idx = -1
+        if all(key in found for key in keys):
+            durations = [found[key] for key in keys]
+        else:
+            durations = self._request_many_to_one(sources_longlats, destination_longlat, sources_data)
+            self._cache_store(keys, durations)
 
         # Finds the shortest travel time and saves index of source
-        for idx, obj in enumerate(response_json['durations']):
-            duration = obj[0]
-            if 0 < duration < travel_time:
-                travel_time = duration
-                saved_idx = idx - 1
+        saved_idx, travel_time = self._argmin_positive(durations, shortcut_threshold_seconds)
+
+        # No source has a valid travel time, returns None instead of an arbitrary source
+        if saved_idx is None:
+            return None, None, destination_longlat
 
-        # Converts travel time to HOURS (to fit simulation framework standards)
-        travel_time = travel_time / 3600
+        # Converts travel time to requested unit, HOURS by default (to fit simulation framework standards)
+        travel_time = travel_time / unit_in_seconds
 
         # Fetches coordinate pair from source that has the shortest travel time to the destination
         source = sources_longlats[saved_idx]
@@ -100,62 +429,94 @@ class TravelTimeOSRMCH:
 
         return travel_time, source, destination_longlat
 
-    def get_travel_time_one_to_many(self, source_longlat, destinations_longlats):
+    def _request_many_to_one(self, sources_longlats, destination_longlat, sources_data=None):
+        """
+        Sends MANY-TO-ONE request to server
+        :param sources_data: Pre-formatted coordinates of sources_longlats (optional)
+        :return: Array of travel times in SECONDS, aligned with sources_longlats
+        """
+
+        # Formats coordinates of sources unless they have been formatted by register_locations
+        if sources_data is None:
+            sources_data = self._format_longlats(sources_longlats)
+
+        # Prepares string for request with matrix coordinates, destination_longlat is placed first (index 0)
+        data_obj = f"{float(destination_longlat[0]):.6f},{float(destination_longlat[1]):.6f};" + sources_data
+
+        # Builds final string for GET request
+        request = self.url + data_obj + self.many_to_one_query
+
+        # Sends request to server
+        response = self._session.get(request, headers=self.headers)
+
+        """
+        Only used for debugging HTTP request errors
+        """
+        # print(response.text)
+        # print(response.status_code, response.reason)
+
+        # Converts durations matrix of response from json to object-structure
+        durations = self._parse_durations(response)
+
+        # First row belongs to the destination itself (index 0), the remaining rows belong to the sources
+        return [obj[0] for obj in durations[1:]]
+
+    def get_travel_time_one_to_many(self, source_longlat, destinations_longlats, shortcut_threshold_seconds=0.0,
+                                    units="hours"):
         """
         Used for ONE-TO-MANY scenarios such as: "patient to hospital"
         :param source_longlat: Array of (ONE) longitude + latitude combination. Represents starting
             location (e.g. patient) in format --> [longitude, latitude]
         :param destinations_longlats: Array of (MANY) longitude + latitude combinations. Represents
             destinations (e.g. hospitals) in format --> [[longitude, latitude], [longitude, latitude], ...]
+            or token returned by register_locations (NumPy array of shape (N, 2) is also accepted)
+        :param shortcut_threshold_seconds: Travel time in SECONDS that is good enough, the first destination below it
+            is returned instead of the closest one (0 disables the shortcut)
+        :param units: Unit of returned travel time, "hours" (default, fits simulation framework standards) or "seconds"
         :return:
-            1. travel_time: Travel time in HOURS
+            1. travel_time: Travel time in HOURS (or SECONDS, see units)
             2. destination: Array object with longitude + latitude of destination that has the shortest travel time from the source
                 in format --> [longitude, latitude]
+                (travel_time and destination are None if no destination has a valid travel time from the source)
             3. source_longlat: Array object with longitude + latitude of source
                 in format --> [longitude, latitude]
         """
 
-        # List of all locations (source + destinations), uses deque to be able to use appendleft-method
-        locations = deque(destinations_longlats)
-        locations.appendleft(source_longlat)
-
-        # Prepares string for request with matrix coordinates
-        data = ""
-        for obj in locations:
-            long_lat = str(obj[0]) + "," + str(obj[1]) + ";"
-            data += long_lat
-
-        # Removes trailing semicolon
-        data_obj = data.rstrip(';')
+        unit_in_seconds = self._unit_in_seconds(units)
 
-        # Builds final string for GET request
-        ending_url = "?sources=0&skip_waypoints=true"
-        request = self.url + data_obj + ending_url
-
-        # Sends request to server
-        response = httpclient.get(request)
+        # Uses pre-formatted coordinates if a token from register_locations is given
+        destinations_data = None
+        if isinstance(destinations_longlats, int):
+            destinations_longlats, destinations_data = self._registered_locations[destinations_longlats]
+        else:
+            destinations_longlats = self._as_longlats(destinations_longlats)
 
-        """
-        Only used for debugging HTTP request errors
-        """
-        # print(response.text)
-        # print(response.status_code, response.reason)
+        # A single destination does not need a search for the shortest travel time, uses the ONE-TO-ONE request instead
+        if len(destinations_longlats) == 1:
+            travel_time, _, destination = self.get_travel_time_one_to_one(source_longlat, destinations_longlats[0], units)
+            if not travel_time:
+                return None, None, source_longlat
+            return travel_time, destination, source_longlat
 
-        # Converts response from json to object-structure
-        response_json = json.loads(response.text)
+        # Travel times in SECONDS from the source to every destination, taken from cache if all of them are known
+        keys = [self._cache_key(source_longlat, obj) for obj in destinations_longlats]
+        found = self._cache_lookup(keys)
 
-        travel_time = sys.maxsize
-        saved_idx = -1
+        if all(key in found for key in keys):
+            durations = [found[key] for key in keys]
+        else:
+            durations = self._request_one_to_many(source_longlat, destinations_longlats, destinations_data)
+            self._cache_store(keys, durations)
 
         # Finds the shortest travel time and saves index of destination
-        for idx, obj in enumerate(response_json['durations'][0]):
-            duration = obj
-            if 0 < duration < travel_time:
-                travel_time = duration
-                saved_idx = idx - 1
+        saved_idx, travel_time = self._argmin_positive(durations, shortcut_threshold_seconds)
+
+        # No destination has a valid travel time, returns None instead of an arbitrary destination
+        if saved_idx is None:
+            return None, None, source_longlat
 
-        # Converts travel time to HOURS (to fit simulation framework standards)
-        travel_time = travel_time / 3600
+        # Converts travel time to requested unit, HOURS by default (to fit simulation framework standards)
+        travel_time = travel_time / unit_in_seconds
 
         # Fetches coordinate pair from destination that has the shortest travel time from the source
         destination = destinations_longlats[saved_idx]
@@ -169,39 +530,97 @@ class TravelTimeOSRMCH:
 
         return travel_time, destination, source_longlat
 
-    def get_travel_time_one_to_one(self, source_longlat, destination_longlat):
+    def _request_one_to_many(self, source_longlat, destinations_longlats, destinations_data=None):
+        """
+        Sends ONE-TO-MANY request to server
+        :param destinations_data: Pre-formatted coordinates of destinations_longlats (optional)
+        :return: Array of travel times in SECONDS, aligned with destinations_longlats
+        """
+
+        # Formats coordinates of destinations unless they have been formatted by register_locations
+        if destinations_data is None:
+            destinations_data = self._format_longlats(destinations_longlats)
+
+        # Prepares string for request with matrix coordinates, source_longlat is placed first (index 0)
+        data_obj = f"{float(source_longlat[0]):.6f},{float(source_longlat[1]):.6f};" + destinations_data
+
+        # Builds final string for GET request
+        request = self.url + data_obj + self.one_to_many_query
+
+        # Sends request to server
+        response = self._session.get(request, headers=self.headers)
+
+        """
+        Only used for debugging HTTP request errors
+        """
+        # print(response.text)
+        # print(response.status_code, response.reason)
+
+        # Converts durations matrix of response from json to object-structure
+        durations = self._parse_durations(response)
+
+        # First column belongs to the source itself (index 0), the remaining columns belong to the destinations
+        return durations[0][1:]
+
+    def get_travel_time_one_to_one(self, source_longlat, destination_longlat, units="hours"):
         """
         Used for ONE-TO-ONE scenarios such as: "hospital to ambulance garage"
         :param source_longlat: Array of (ONE) longitude + latitude combination. Represents starting
             location (e.g. hospital) in format --> [longitude, latitude]
         :param destination_longlat: Array of (ONE) longitude + latitude combination. Represents
             destination (e.g. ambulance garage) in format --> [longitude, latitude]
+        :param units: Unit of returned travel time, "hours" (default, fits simulation framework standards) or "seconds"
         :return:
-            1. travel_time: Travel time in HOURS
-            2. source_longlat: rray object with longitude + latitude of source
+            1. travel_time: Travel time in HOURS (or SECONDS, see units), None if the server found no route
+            2. source_longlat: Array object with longitude + latitude of source
                 in format --> [longitude, latitude]
             3. destination_longlat: Array object with longitude + latitude of destination
                 in format --> [longitude, latitude]
         """
 
-        # Object with source + destination
-        locations = [source_longlat] + [destination_longlat]
+        unit_in_seconds = self._unit_in_seconds(units)
+
+        # Uses cached travel time if this source + destination has been requested before
+        key = self._cache_key(source_longlat, destination_longlat)
+        found = self._cache_lookup([key])
+
+        if key in found:
+            duration = found[key]
+        else:
+            duration = self._request_one_to_one(source_longlat, destination_longlat)
+            self._cache_store([key], [duration])
+
+        # No route between source and destination
+        if duration is None:
+            return None, source_longlat, destination_longlat
+
+        # Converts travel time to requested unit, HOURS by default (to fit simulation framework standards)
+        travel_time = duration / unit_in_seconds
+
+        """
+        Only used for debugging return values
+        """
+        # print("travel_time: ", travel_time)
+        # print("source: ", source_longlat)
+        # print("destination_longlat: ", destination_longlat)
+
+        return travel_time, source_longlat, destination_longlat
 
-        # Prepares string for request
-        data = ""
-        for obj in locations:
-            long_lat = str(obj[0]) + "," + str(obj[1]) + ";"
-            data += long_lat
+    def _request_one_to_one(self, source_longlat, destination_longlat):
+        """
+        Sends ONE-TO-ONE request to server
+        :return: Travel time in SECONDS
+        """
 
-        # Removes trailing semicolon
-        data_obj = data.rstrip(';')
+        # Prepares string for request with source (index 0) + destination (index 1)
+        data_obj = f"{float(source_longlat[0]):.6f},{float(source_longlat[1]):.6f};" \
+                   f"{float(destination_longlat[0]):.6f},{float(destination_longlat[1]):.6f}"
 
         # Builds final string for GET request
-        ending_url = "?sources=0&destinations=1&skip_waypoints=true"
-        request = self.url + data_obj + ending_url
+        request = self.url + data_obj + self.one_to_one_query
 
         # Sends request to server
-        response = httpclient.get(request)
+        response = self._session.get(request, headers=self.headers)
 
         """
         Only used for debugging HTTP request errors
@@ -209,17 +628,302 @@ class TravelTimeOSRMCH:
         # print(response.text)
         # print(response.status_code, response.reason)
 
-        # Converts response from json to object-structure
-        response_json = json.loads(response.text)
+        # Converts durations matrix of response from json to object-structure
+        durations = self._parse_durations(response)
 
-        # Converts travel time to HOURS (to fit simulation framework standards)
-        travel_time = response_json['durations'][0][0] / 3600
+        return durations[0][0]
 
+    def get_travel_time_batch(self, pairs, units="hours"):
         """
-        Only used for debugging return values
+        Used for several ONE-TO-ONE scenarios at once, answered with a single request to the server
+        :param pairs: Array of source + destination combinations. Each source and destination is a longitude + latitude
+            combination in format --> [[[longitude, latitude], [longitude, latitude]], ...]
+        :param units: Unit of returned travel time, "hours" (default, fits simulation framework standards) or "seconds"
+        :return: Array aligned with pairs, where each element contains (same as get_travel_time_one_to_one):
+            1. travel_time: Travel time in HOURS (or SECONDS, see units), None if the server found no route
+            2. source_longlat: Array object with longitude + latitude of source
+                in format --> [longitude, latitude]
+            3. destination_longlat: Array object with longitude + latitude of destination
+                in format --> [longitude, latitude]
         """
-        # print("travel_time: ", travel_time)
-        # print("source: ", source_longlat)
-        # print("destination_longlat: ", destination_longlat)
 
-        return travel_time, source_longlat, destination_longlat
+        unit_in_seconds = self._unit_in_seconds(units)
+        durations = self._get_durations(pairs)
+
+        # Converts travel time of every pair to requested unit
+        return [(None if duration is None else duration / unit_in_seconds, source_longlat, destination_longlat)
+                for (source_longlat, destination_longlat), duration in zip(pairs, durations)]
+
+    def _get_durations(self, pairs):
+        """
+        Gets travel times of source + destination pairs from cache, pairs that are not cached yet are sent to the
+        server in a single request
+        :return: Array of travel times in SECONDS, aligned with pairs
+        """
+
+        keys = [self._cache_key(source_longlat, destination_longlat) for source_longlat, destination_longlat in pairs]
+        found = self._cache_lookup(keys)
+
+        # Only pairs that are not cached yet are sent to the server
+        missing_pairs = [pair for pair, key in zip(pairs, keys) if key not in found]
+        if missing_pairs:
+            missing_keys = [self._cache_key(source_longlat, destination_longlat)
+                            for source_longlat, destination_longlat in missing_pairs]
+            missing_durations = self._request_batch(missing_pairs)
+            self._cache_store(missing_keys, missing_durations)
+            found.update(zip(missing_keys, missing_durations))
+
+        return [found[key] for key in keys]
+
+    def _request_batch(self, pairs):
+        """
+        Sends batch of ONE-TO-ONE scenarios to server in as few requests as possible, each request has at most
+        max_table_size unique locations
+        :return: Array of travel times in SECONDS, aligned with pairs
+        """
+
+        durations = []
+        chunk = []
+        chunk_locations = set()
+
+        for source_longlat, destination_longlat in pairs:
+            locations = {(source_longlat[0], source_longlat[1]), (destination_longlat[0], destination_longlat[1])}
+
+            # Sends collected pairs before the request would have too many locations
+            if chunk and len(chunk_locations) + len(locations - chunk_locations) > self.max_table_size:
+                durations += self._request_table(chunk)
+                chunk = []
+                chunk_locations = set()
+
+            chunk.append((source_longlat, destination_longlat))
+            chunk_locations |= locations
+
+        if chunk:
+            durations += self._request_table(chunk)
+
+        return durations
+
+    def _request_table(self, pairs):
+        """
+        Sends ONE-TO-ONE scenarios to server as a single request
+        :return: Array of travel times in SECONDS, aligned with pairs
+        """
+
+        # List of all unique locations, each location is only sent once to the server
+        locations = []
+        location_idxs = {}
+
+        # Maps index of location to its row (source) and column (destination) in the returned matrix
+        rows = {}
+        columns = {}
+
+        # Index of source + destination in locations for every pair
+        pair_idxs = []
+
+        for source_longlat, destination_longlat in pairs:
+            idxs = []
+            for obj in (source_longlat, destination_longlat):
+                key = (obj[0], obj[1])
+                if key not in location_idxs:
+                    location_idxs[key] = len(locations)
+                    locations.append(obj)
+                idxs.append(location_idxs[key])
+            rows.setdefault(idxs[0], len(rows))
+            columns.setdefault(idxs[1], len(columns))
+            pair_idxs.append(idxs)
+
+        # Prepares string for request with matrix coordinates
+        data_obj = self._format_longlats(locations)
+
+        # Builds final string for GET request
+        ending_url = "?sources=" + ";".join(str(idx) for idx in rows) + \
+                     "&destinations=" + ";".join(str(idx) for idx in columns) + self.batch_query
+        request = self.url + data_obj + ending_url
+
+        # Sends request to server
+        response = self._session.get(request, headers=self.headers)
+
+        # Converts durations matrix of response from json to object-structure
+        durations = self._parse_durations(response)
+
+        # Picks travel time of every pair from the matrix
+        return [durations[rows[source_idx]][columns[destination_idx]] for source_idx, destination_idx in pair_idxs]
+
+    def flush(self, units="hours"):
+        """
+        Sends all queued scenarios to the server in a single request and empties the queue
+        :param units: Unit of returned travel times, "hours" (default) or "seconds"
+        :return: Array aligned with the order scenarios were queued in, every element has the same format as the
+            return value of the matching get_travel_time_* method
+        """
+
+        # Queue is only emptied when all scenarios have been answered, so no queued scenario is lost on errors
+        pending = list(self._pending)
+        results = self._flush_pending(pending, units)
+        del self._pending[:len(pending)]
+        return results
+
+    def _flush_pending(self, pending, units):
+        """
+        Sends queued scenarios to the server in a single request, see flush()
+        """
+
+        unit_in_seconds = self._unit_in_seconds(units)
+
+        # Every scenario is split into source + destination pairs, so all of them fit in the same matrix
+        pairs = [(source_longlat, destination_longlat)
+                 for _, sources_longlats, destinations_longlats in pending
+                 for source_longlat in sources_longlats for destination_longlat in destinations_longlats]
+        durations = self._get_durations(pairs)
+
+        results = []
+        start_idx = 0
+        for scenario, sources_longlats, destinations_longlats in pending:
+            end_idx = start_idx + len(sources_longlats) * len(destinations_longlats)
+            scenario_durations = durations[start_idx:end_idx]
+            start_idx = end_idx
+
+            if scenario == "one_to_one":
+                duration = scenario_durations[0]
+                travel_time = None if duration is None else duration / unit_in_seconds
+                results.append((travel_time, sources_longlats[0], destinations_longlats[0]))
+                continue
+
+            # Finds the shortest travel time, same as get_travel_time_many_to_one + get_travel_time_one_to_many
+            saved_idx, travel_time = self._argmin_positive(scenario_durations)
+            if scenario == "many_to_one":
+                fixed_longlat, candidates = destinations_longlats[0], sources_longlats
+            else:
+                fixed_longlat, candidates = sources_longlats[0], destinations_longlats
+
+            if saved_idx is None:
+                results.append((None, None, fixed_longlat))
+            else:
+                results.append((travel_time / unit_in_seconds, candidates[saved_idx], fixed_longlat))
+
+        return results
+
+class TravelTimeOSRMCHPool(_TravelTimeQueueMixin):
+    '''
+    Class used to spread travel time calculations over several OpenSourceRoutingMachine servers, e.g. when one
+    server can not keep up with the simulation. Each scenario is sent to the next server in turn (round-robin).
+    Provides the same methods as TravelTimeOSRMCH
+
+    :var (list) clients: Input TravelTimeOSRMCH instances, one per OSRM server
+        (e.g. [TravelTimeOSRMCH("127.0.0.1", "5001"), TravelTimeOSRMCH("127.0.0.1", "5002")]).
+        All clients share the cache of the first client (including its cache_path and cache_maxsize), so a travel
+        time fetched from one server is a cache hit for every server
+    '''
+
+    def __init__(self, clients):
+        self.clients = list(clients)
+        if not self.clients:
+            raise ValueError("clients must contain at least one TravelTimeOSRMCH instance")
+
+        for client in self.clients[1:]:
+            client._share_cache(self.clients[0])
+
+        # Endless iterator over index of the client that handles the next scenario
+        self._next_client_idx = cycle(range(len(self.clients)))
+        # Tokens from register_locations of every client, the index in the list is used as token of the pool
+        self._registered_locations = []
+        # Queue of scenarios waiting for flush(), see TravelTimeOSRMCH
+        self._pending = []
+
+    def _next_client(self, longlats):
+        """
+        Picks client for the next scenario, translates token from register_locations into the token of that client
+        :return:
+            1. client: TravelTimeOSRMCH instance to use
+            2. longlats: Array of longitude + latitude combinations or token of the client
+        """
+
+        idx = next(self._next_client_idx)
+        if isinstance(longlats, int):
+            longlats = self._registered_locations[longlats][idx]
+        return self.clients[idx], longlats
+
+    def register_locations(self, longlats):
+        """
+        Registers a fixed set of locations on every server, see TravelTimeOSRMCH.register_locations
+        :return: Token that can be used instead of the array in get_travel_time_many_to_one (sources_longlats) and
+            get_travel_time_one_to_many (destinations_longlats)
+        """
+
+        self._registered_locations.append([client.register_locations(longlats) for client in self.clients])
+        return len(self._registered_locations) - 1
+
+    def get_travel_time_many_to_one(self, sources_longlats, destination_longlat, *args, **kwargs):
+        """
+        See TravelTimeOSRMCH.get_travel_time_many_to_one
+        """
+
+        client, sources_longlats = self._next_client(sources_longlats)
+        return client.get_travel_time_many_to_one(sources_longlats, destination_longlat, *args, **kwargs)
+
+    def get_travel_time_one_to_many(self, source_longlat, destinations_longlats, *args, **kwargs):
+        """
+        See TravelTimeOSRMCH.get_travel_time_one_to_many
+        """
+
+        client, destinations_longlats = self._next_client(destinations_longlats)
+        return client.get_travel_time_one_to_many(source_longlat, destinations_longlats, *args, **kwargs)
+
+    def get_travel_time_one_to_one(self, source_longlat, destination_longlat, *args, **kwargs):
+        """
+        See TravelTimeOSRMCH.get_travel_time_one_to_one
+        """
+
+        client, _ = self._next_client(None)
+        return client.get_travel_time_one_to_one(source_longlat, destination_longlat, *args, **kwargs)
+
+    def get_travel_time_batch(self, pairs, *args, **kwargs):
+        """
+        See TravelTimeOSRMCH.get_travel_time_batch
+        """
+
+        client, _ = self._next_client(None)
+        return client.get_travel_time_batch(pairs, *args, **kwargs)
+
+    def _resolve_longlats(self, longlats):
+        """
+        Converts token from register_locations or NumPy array to an array of longitude + latitude combinations
+        """
+
+        # Every client has the same locations registered, uses the token of the first client
+        if isinstance(longlats, int):
+            longlats = self._registered_locations[longlats][0]
+        return self.clients[0]._resolve_longlats(longlats)
+
+    def flush(self, units="hours"):
+        """
+        Sends all queued scenarios to the next server in turn, see TravelTimeOSRMCH.flush
+        """
+
+        # Queue is only emptied when all scenarios have been answered, so no queued scenario is lost on errors
+        pending = list(self._pending)
+        client, _ = self._next_client(None)
+        results = client._flush_pending(pending, units)
+        del self._pending[:len(pending)]
+        return results
+
+    def clear_cache(self):
+        """
+        Removes all cached travel times (shared by every client), see TravelTimeOSRMCH.clear_cache
+        """
+
+        self.clients[0].clear_cache()
+
+    def close(self):
+        """
+        Closes the cache file shared by every client, see TravelTimeOSRMCH.close
+        """
+
+        for client in self.clients:
+            client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()